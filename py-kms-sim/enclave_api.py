@@ -1,58 +1,138 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import asyncio
+
+from fastapi import FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, StrictInt, StrictStr
 import enclave_kms as keymanager
+import orjson
 import os
-app = Flask(__name__)
-CORS(app)
 
-ENCLAVE_SECRET = os.getenv("ENCLAVE_SECRET")
 
-@app.route('/generate', methods=['POST'])
-def generate():
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized with orjson"""
+
+    def render(self, content):
+        return orjson.dumps(content)
+
+
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+# Upper bound on accounts created by a single /generate_batch call
+MAX_BATCH_SIZE = 256
+
+# Bounded pool for key manager calls. libsecp256k1 and AES-GCM release the GIL, so threads sign
+# in parallel without pickling requests to other processes, and they share this worker's key cache
+_crypto_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+# Error messages for bad request bodies, shared by the handlers and the validation error handler
+BATCH_COUNT_ERROR = f"count must be an integer between 1 and {MAX_BATCH_SIZE}"
+SIGN_REQUEST_ERROR = "Address and message required"
+INVALID_REQUEST_ERROR = "Invalid request body"
+
+
+# Strict types: no coercion of e.g. true -> 1 or 123 -> "123"
+class GenerateBatchRequest(BaseModel):
+    count: Optional[StrictInt] = None
+
+
+class SignRequest(BaseModel):
+    address: Optional[StrictStr] = None
+    message: Optional[StrictStr] = None
+
+
+def error(message, status_code):
+    """Error response in the {"error": ...} shape the Next.js backend expects"""
+    return ORJSONResponse({"error": message}, status_code=status_code)
+
+@app.exception_handler(RequestValidationError)
+async def validation_error(request: Request, exc: RequestValidationError):
+    """Answer malformed bodies with 400 and {"error": ...} instead of FastAPI's 422 {"detail": ...}"""
+    messages = {'/generate_batch': BATCH_COUNT_ERROR, '/sign': SIGN_REQUEST_ERROR}
+    return error(messages.get(request.url.path, INVALID_REQUEST_ERROR), 400)
+
+async def run_blocking(func, *args):
+    """Run a blocking key manager call on the crypto pool so it never stalls the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(_crypto_executor, func, *args)
+
+def _generate_and_store(count):
+    """Generate, encrypt and store `count` accounts, returning them"""
+    accounts = keymanager.generate_ethereum_accounts(count)
+    keymanager.store_keys({
+        account['address']: keymanager.encrypt_key(account['private_key'], keymanager.SECRET)
+        for account in accounts
+    })
+    return accounts
+
+@app.post('/generate')
+async def generate():
     """Generate a new Ethereum account and store it encrypted in the enclave"""
-    account = keymanager.generate_ethereum_account()
-    encrypted = keymanager.encrypt_key(account['private_key'], ENCLAVE_SECRET)
-    keymanager.store_key(account['address'], encrypted)
+    account = (await run_blocking(_generate_and_store, 1))[0]
     
-    return jsonify({
+    return {
         "address": account['address'],
         "message": "Account generated and stored in enclave"
-    })
+    }
 
-@app.route('/addresses', methods=['GET'])
-def addresses():
+@app.post('/generate_batch')
+async def generate_batch(body: Optional[GenerateBatchRequest] = None):
+    """Generate several Ethereum accounts at once and store them encrypted in the enclave"""
+    count = body.count if body else None
+    if count is None or not 1 <= count <= MAX_BATCH_SIZE:
+        return error(BATCH_COUNT_ERROR, 400)
+    
+    accounts = await run_blocking(_generate_and_store, count)
+    
+    return {
+        "addresses": [account['address'] for account in accounts],
+        "message": f"{count} accounts generated and stored in enclave"
+    }
+
+@app.get('/addresses')
+async def addresses():
     """List all addresses stored in the enclave"""
-    return jsonify(keymanager.list_addresses())
+    return await run_blocking(keymanager.list_addresses)
 
-@app.route('/sign', methods=['POST'])
-def sign():
+@app.post('/sign')
+async def sign(body: SignRequest):
     """Sign a message using a private key stored in the enclave"""
-    address = request.json.get('address')
-    message = request.json.get('message')
+    address = body.address
+    message = body.message
     print(f"Signing message: {message} for address: {address}")
     
     if not address or not message:
-        return jsonify({"error": "Address and message required"}), 400
-    
-    encrypted = keymanager.get_key(address)
-    if not encrypted:
-        return jsonify({"error": "Address not found"}), 404
-    
-    # Decrypt using enclave secret
-    private_key = keymanager.decrypt_key(encrypted, ENCLAVE_SECRET)
-    if not private_key:
-        return jsonify({"error": "Failed to decrypt key"}), 500
+        return error(SIGN_REQUEST_ERROR, 400)
     
     # Sign the message - note the parameter order: message, address
-    signature = keymanager.sign_message(message, address)
+    # The key is decrypted (and cached) by the key manager; None means a missing or bad key
+    signature = await run_blocking(keymanager.sign_message, message, address)
     if not signature:
-        return jsonify({"error": "Failed to sign message"}), 500
+        if not await run_blocking(keymanager.get_key, address):
+            return error("Address not found", 404)
+        return error("Failed to sign message", 500)
     
     # Ensure signature has 0x prefix
     if not signature.startswith('0x'):
         signature = '0x' + signature
     
-    return jsonify({"signature": signature})
+    return {"signature": signature}
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    import uvicorn
+
+    # Signing is CPU-bound: one worker process per core by default. Every worker keeps its
+    # own in-memory keystore, kept in sync through the keystore files.
+    host, port = os.getenv("ENCLAVE_BIND", "127.0.0.1:5000").rsplit(":", 1)
+    uvicorn.run(
+        "enclave_api:app",
+        host=host,
+        port=int(port),
+        workers=int(os.getenv("ENCLAVE_WORKERS", os.cpu_count())),
+        loop="uvloop",
+        http="httptools",
+    )
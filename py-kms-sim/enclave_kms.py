@@ -1,73 +1,286 @@
-from eth_account import Account
 import secrets
-import json
+import orjson
+import fcntl
+import threading
+from functools import lru_cache
 import os
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF, HKDFExpand
+from Crypto.Hash import keccak
+from coincurve import PrivateKey, PublicKey
 from dotenv import load_dotenv
-from eth_account.messages import encode_defunct
 
 load_dotenv()
 
 # File for storing encrypted keys
 KEYSTORE_PATH = "keystore.json"
 
+# Append-only log of keys stored since the keystore file was last compacted
+KEYSTORE_LOG_PATH = "keystore.jsonl"
+
+# Number of log entries after which the log is folded back into KEYSTORE_PATH
+COMPACT_THRESHOLD = 1000
+
 # Secret for encrypting and decrypting keys - simulates the root of trust for the enclave
 SECRET = os.getenv("ENCLAVE_SECRET")
 
+# Context string binding derived wrapping keys to this keystore format
+KDF_INFO = b"pass-wallet-kms:aes-256-gcm"
+
+# EIP-191 version 0x45 (personal_sign) prefix, followed by the message length and the message
+EIP191_PREFIX = b"\x19Ethereum Signed Message:\n"
+
+# Salt used to extract the master key from SECRET; per-key wrapping keys are expanded from it
+MASTER_KEY_SALT = b"enclave-kms-v1"
+
+# In-memory view of the keystore, loaded once and refreshed only when the files change
+_keystore = {}
+_log_entries = 0
+_log_offset = 0
+_disk_state = None
+_keystore_lock = threading.Lock()
+
+def generate_ethereum_accounts(n):
+    """Generate n new Ethereum accounts (private key and address), drawing all key material at once"""
+    entropy = secrets.token_bytes(32 * n)
+    accounts = []
+    for i in range(n):
+        key_bytes = entropy[32 * i:32 * (i + 1)]
+        try:
+            private_key = PrivateKey(key_bytes)
+        except ValueError:
+            # Out-of-range scalar (probability ~2^-128): draw a fresh one
+            key_bytes = secrets.token_bytes(32)
+            private_key = PrivateKey(key_bytes)
+        accounts.append({
+            "address": _to_checksum_address(_public_key_to_address(private_key.public_key)),
+            "private_key": "0x" + key_bytes.hex()
+        })
+    return accounts
+
 def generate_ethereum_account():
     """Generate a new Ethereum account (private key and address)"""
-    private_key = "0x" + secrets.token_hex(32)
-    account = Account.from_key(private_key)
-    return {
-        "address": account.address,
-        "private_key": private_key
-    }
+    return generate_ethereum_accounts(1)[0]
+
+@lru_cache(maxsize=4)
+def _master_key(secret):
+    """Extract the 256-bit master key from the enclave secret (done once per secret)"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=MASTER_KEY_SALT, info=b"")
+    return hkdf.derive(secret.encode())
+
+def _derive_key(secret, salt):
+    """Derive a 256-bit wrapping key from the enclave secret and a per-key salt"""
+    return HKDFExpand(algorithm=hashes.SHA256(), length=32, info=KDF_INFO + salt).derive(_master_key(secret))
+
+# Derive the master key at startup so no request pays for it
+if SECRET:
+    _master_key(SECRET)
 
 def encrypt_key(private_key, secret):
     """Encrypt private key with a secret"""
-    account = Account.from_key(private_key)
-    encrypted = Account.encrypt(private_key, secret)
-    return encrypted
+    salt = secrets.token_bytes(16)
+    nonce = secrets.token_bytes(12)
+    ciphertext = AESGCM(_derive_key(secret, salt)).encrypt(
+        nonce, bytes.fromhex(private_key[2:] if private_key[:2] == "0x" else private_key), None
+    )
+    return {
+        "salt": salt.hex(),
+        "nonce": nonce.hex(),
+        "ciphertext": ciphertext.hex(),
+    }
 
 def decrypt_key(encrypted_key, secret):
     """Decrypt an encrypted key"""
+    # Keys stored before the AES-GCM migration are Web3 (scrypt) keystore JSON
+    if "crypto" in encrypted_key:
+        # Imported lazily: eth_account (and its keyfile/BLS deps) dominates module import time
+        from eth_account import Account
+        try:
+            private_key = Account.decrypt(encrypted_key, secret)
+            return "0x" + private_key.hex()
+        except ValueError:
+            return None
+
     try:
-        private_key = Account.decrypt(encrypted_key, secret)
+        key = _derive_key(secret, bytes.fromhex(encrypted_key["salt"]))
+        private_key = AESGCM(key).decrypt(
+            bytes.fromhex(encrypted_key["nonce"]),
+            bytes.fromhex(encrypted_key["ciphertext"]),
+            None,
+        )
         return "0x" + private_key.hex()
-    except ValueError:
+    except (InvalidTag, KeyError, ValueError):
         return None
 
-def store_key(address, encrypted_key):
-    """Store an encrypted key in the local keystore"""
+def _file_state(path):
+    """Identify the current version of a file on disk (None if missing)"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _replay_log(log, keystore, offset=0):
+    """Apply the log records from `offset` onwards to `keystore`
+
+    Returns the number of records applied and the offset just past the last one. The caller
+    must hold a lock on `log` so no half-written record is read.
+    """
+    # Read the whole tail in one call rather than line by line through the file buffer
+    log.seek(offset)
+    data = log.read()
+    applied = 0
+    for line in data.splitlines():
+        if line.strip():
+            keystore.update(orjson.loads(line))
+            applied += 1
+    return applied, offset + len(data)
+
+def _load_keystore(log):
+    """Read the keystore snapshot and replay the append-only log on top of it
+
+    The caller must hold a lock on `log` so a compaction cannot slip in between the two reads
+    """
+    keystore = {}
     if os.path.exists(KEYSTORE_PATH):
-        with open(KEYSTORE_PATH, "r") as f:
-            keystore = json.load(f)
+        with open(KEYSTORE_PATH, "rb") as f:
+            keystore = orjson.loads(f.read())
+
+    log_entries, log_offset = _replay_log(log, keystore)
+    return keystore, log_entries, log_offset
+
+def _only_log_grew(disk_state):
+    """True if the snapshot is unchanged since the last sync and the log was only appended to"""
+    if _disk_state is None or disk_state[0] != _disk_state[0]:
+        return False
+    old_log, new_log = _disk_state[1], disk_state[1]
+    # Same log file (inode) that has not been truncated below what was already replayed
+    return old_log is not None and new_log is not None and old_log[0] == new_log[0] and new_log[2] >= _log_offset
+
+def _disk_snapshot():
+    """Current version of the keystore snapshot and log on disk"""
+    return (_file_state(KEYSTORE_PATH), _file_state(KEYSTORE_LOG_PATH))
+
+def _refresh(log):
+    """Bring the in-memory keystore up to date, replaying only the new log tail when possible
+
+    The caller must hold a lock on `log`; the files are stat'ed under it so a compaction
+    cannot land between the stat and the reads
+    """
+    global _keystore, _log_entries, _log_offset, _disk_state
+    disk_state = _disk_snapshot()
+    if disk_state == _disk_state:
+        return
+
+    if _only_log_grew(disk_state):
+        applied, _log_offset = _replay_log(log, _keystore, _log_offset)
+        _log_entries += applied
     else:
-        keystore = {}
-    
-    keystore[address] = encrypted_key
-    
-    with open(KEYSTORE_PATH, "w") as f:
-        json.dump(keystore, f, indent=2)
+        _keystore, _log_entries, _log_offset = _load_keystore(log)
+    _disk_state = disk_state
+
+def _sync(log=None):
+    """Reload the in-memory keystore if the files changed on disk (e.g. another worker wrote)"""
+    # Unlocked fast path: nothing changed since the last (locked) refresh
+    if _disk_snapshot() == _disk_state:
+        return
+
+    if log is None:
+        with open(KEYSTORE_LOG_PATH, "a+b") as log:
+            fcntl.flock(log, fcntl.LOCK_SH)
+            _refresh(log)
+    else:
+        _refresh(log)
+
+def _compact(log):
+    """Fold the append-only log into the keystore snapshot and truncate it"""
+    tmp_path = KEYSTORE_PATH + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(_keystore, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_path, KEYSTORE_PATH)
+    log.truncate(0)
+
+def store_keys(encrypted_keys):
+    """Store several encrypted keys (address -> encrypted key) with a single log write"""
+    global _log_entries, _log_offset, _disk_state
+    with _keystore_lock, open(KEYSTORE_LOG_PATH, "a+b") as log:
+        fcntl.flock(log, fcntl.LOCK_EX)
+        _sync(log)
+
+        log.write(b"".join(
+            orjson.dumps({address: encrypted_key}) + b"\n"
+            for address, encrypted_key in encrypted_keys.items()
+        ))
+        log.flush()
+        replaced = any(address in _keystore for address in encrypted_keys)
+        _keystore.update(encrypted_keys)
+        _log_entries += len(encrypted_keys)
+        _log_offset = log.tell()
+
+        if _log_entries >= COMPACT_THRESHOLD:
+            _compact(log)
+            _log_entries = 0
+            _log_offset = 0
+
+        _disk_state = _disk_snapshot()
+
+    # A replaced key must not be served from this worker's cache. Other workers keep theirs until
+    # eviction; new addresses (all /generate produces) cannot be cached anywhere yet
+    if replaced:
+        _load_private_key.cache_clear()
+
+def store_key(address, encrypted_key):
+    """Store an encrypted key in the local keystore"""
+    store_keys({address: encrypted_key})
 
 def get_key(address):
     """Retrieve an encrypted key from the keystore"""
-    if not os.path.exists(KEYSTORE_PATH):
-        return None
-    
-    with open(KEYSTORE_PATH, "r") as f:
-        keystore = json.load(f)
-    
-    return keystore.get(address)
+    with _keystore_lock:
+        _sync()
+        return _keystore.get(address)
 
 def list_addresses():
     """List all addresses in the keystore"""
-    if not os.path.exists(KEYSTORE_PATH):
-        return []
-    
-    with open(KEYSTORE_PATH, "r") as f:
-        keystore = json.load(f)
-    
-    return list(keystore.keys())
+    with _keystore_lock:
+        _sync()
+        return list(_keystore.keys())
+
+def _keccak256(data: bytes) -> bytes:
+    """Keccak-256 via pycryptodome's C implementation, bypassing eth_utils' input dispatch"""
+    return keccak.new(data=data, digest_bits=256).digest()
+
+def _eip191_digest(message: str) -> bytes:
+    """Hash a text message the way EIP-191 personal_sign (encode_defunct) does"""
+    data = message.encode()
+    return _keccak256(EIP191_PREFIX + str(len(data)).encode() + data)
+
+def _public_key_to_address(public_key: PublicKey) -> str:
+    """Derive the (lowercase) Ethereum address of a secp256k1 public key"""
+    return "0x" + _keccak256(public_key.format(compressed=False)[1:])[-20:].hex()
+
+def _to_checksum_address(address: str) -> str:
+    """EIP-55 mixed-case checksum encoding of a lowercase 0x-prefixed address"""
+    hex_address = address[2:]
+    digest = _keccak256(hex_address.encode()).hex()
+    return "0x" + "".join(c.upper() if int(d, 16) >= 8 else c for c, d in zip(hex_address, digest))
+
+@lru_cache(maxsize=1024)
+def _load_private_key(address):
+    """Load and decrypt the private key for an address, caching the result per address
+
+    Raises KeyError / ValueError instead of returning None so that misses are not cached
+    """
+    encrypted_key = get_key(address)
+    if not encrypted_key:
+        raise KeyError(address)
+
+    private_key = decrypt_key(encrypted_key, SECRET)
+    if not private_key:
+        raise ValueError(f"Failed to decrypt key for {address}")
+
+    return PrivateKey(bytes.fromhex(private_key[2:]))
 
 def sign_message(message: str, address: str) -> str:
     """Sign a message using the private key associated with the given address
@@ -79,23 +292,16 @@ def sign_message(message: str, address: str) -> str:
     Returns:
         The signature as a hex string, or None if the key cannot be found/decrypted
     """
-    # Get the encrypted key from keystore
-    encrypted_key = get_key(address)
-    if not encrypted_key:
-        return None
-    
-    # Decrypt the private key
-    private_key = decrypt_key(encrypted_key, SECRET)
-    if not private_key:
+    # Get the decrypted key, only hitting the keystore on a cache miss
+    try:
+        private_key = _load_private_key(address)
+    except (KeyError, ValueError):
         return None
     
-    # Create account and sign message
-    account = Account.from_key(private_key)
-    # Create an EIP-191 encoded message
-    message_to_sign = encode_defunct(text=message)
-    signed_message = account.sign_message(message_to_sign)
-    
-    return signed_message.signature.hex()
+    # Sign the EIP-191 digest directly with libsecp256k1
+    signature = private_key.sign_recoverable(_eip191_digest(message), hasher=None)
+    # coincurve returns r || s || recovery id; Ethereum expects v = 27 + recovery id
+    return (signature[:64] + bytes([signature[64] + 27])).hex()
 
 def verify_message(message: str, signature: str, address: str) -> bool:
     """Verify a message signature
@@ -108,13 +314,29 @@ def verify_message(message: str, signature: str, address: str) -> bool:
     Returns:
         True if the signature is valid, False otherwise
     """
-    # Create an EIP-191 encoded message
-    message_to_verify = encode_defunct(text=message)
-    # Convert hex signature to bytes
-    signature_bytes = bytes.fromhex(signature.replace('0x', ''))
-    # Verify the signature
-    verified = Account.recover_message(message_to_verify, signature=signature_bytes)
-    return verified.lower() == address.lower()
+    # Convert hex signature to bytes, stripping only a leading 0x
+    try:
+        signature_bytes = bytes.fromhex(signature[2:] if signature[:2] == '0x' else signature)
+    except ValueError:
+        return False
+    if len(signature_bytes) != 65:
+        return False
+
+    # Accept both v in {27, 28} and a raw recovery id in {0, 1}
+    v = signature_bytes[64]
+    if v not in (0, 1, 27, 28):
+        return False
+    recovery_id = v - 27 if v >= 27 else v
+
+    # Recover rather than verify against a known key: this matches eth_account's handling of
+    # v and high-s signatures
+    try:
+        public_key = PublicKey.from_signature_and_message(
+            signature_bytes[:64] + bytes([recovery_id]), _eip191_digest(message), hasher=None
+        )
+    except ValueError:
+        return False
+    return _public_key_to_address(public_key) == address.lower()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,22 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+# The simulator modules live one level up and are imported as top-level modules
+KMS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, KMS_DIR)
+
+TEST_SECRET = "test-enclave-secret"
+
+
+@pytest.fixture
+def kms(tmp_path, monkeypatch):
+    """enclave_kms with fresh in-memory state and its keystore files in a temp dir"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("ENCLAVE_SECRET", TEST_SECRET)
+    import enclave_kms
+    enclave_kms = importlib.reload(enclave_kms)
+    yield enclave_kms
+    enclave_kms._load_private_key.cache_clear()
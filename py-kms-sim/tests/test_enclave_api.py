@@ -0,0 +1,59 @@
+import importlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def client(kms):
+    import enclave_api
+    return TestClient(importlib.reload(enclave_api).app)
+
+
+def test_generate_and_sign(client, kms):
+    address = client.post("/generate").json()["address"]
+    assert address in client.get("/addresses").json()
+
+    response = client.post("/sign", json={"address": address, "message": "hello"})
+    assert response.status_code == 200
+    assert kms.verify_message("hello", response.json()["signature"], address)
+
+
+def test_generate_batch(client):
+    response = client.post("/generate_batch", json={"count": 3})
+    assert response.status_code == 200
+    assert set(response.json()["addresses"]) <= set(client.get("/addresses").json())
+
+
+def test_sign_unknown_address(client):
+    response = client.post("/sign", json={"address": "0xdead", "message": "hello"})
+    assert response.status_code == 404
+    assert response.json() == {"error": "Address not found"}
+
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    {"content": b"{not json", "headers": {"content-type": "application/json"}},
+    {"json": {"message": "hello"}},
+    {"json": {"address": 123, "message": "hello"}},
+    {"json": {"address": "0xdead", "message": ["hello"]}},
+])
+def test_bad_sign_requests_get_400(client, kwargs):
+    response = client.post("/sign", **kwargs)
+    assert response.status_code == 400
+    assert response.json() == {"error": "Address and message required"}
+
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    {"content": b"{not json", "headers": {"content-type": "application/json"}},
+    {"json": {"count": 0}},
+    {"json": {"count": 257}},
+    {"json": {"count": "abc"}},
+    {"json": {"count": 2.5}},
+    {"json": {"count": True}},
+])
+def test_bad_batch_requests_get_400(client, kwargs):
+    response = client.post("/generate_batch", **kwargs)
+    assert response.status_code == 400
+    assert response.json() == {"error": "count must be an integer between 1 and 256"}
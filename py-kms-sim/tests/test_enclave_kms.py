@@ -0,0 +1,172 @@
+import subprocess
+import sys
+
+import orjson
+from eth_account import Account
+from eth_account.messages import encode_defunct
+
+from conftest import KMS_DIR, TEST_SECRET
+
+
+def create_accounts(kms, n):
+    accounts = kms.generate_ethereum_accounts(n)
+    kms.store_keys({a["address"]: kms.encrypt_key(a["private_key"], kms.SECRET) for a in accounts})
+    return accounts
+
+
+def test_generated_accounts_match_eth_account(kms):
+    for account in kms.generate_ethereum_accounts(8):
+        assert Account.from_key(account["private_key"]).address == account["address"]
+
+
+def test_encrypt_decrypt_round_trip(kms):
+    account = kms.generate_ethereum_account()
+    encrypted = kms.encrypt_key(account["private_key"], kms.SECRET)
+    assert kms.decrypt_key(encrypted, kms.SECRET) == account["private_key"]
+    assert kms.decrypt_key(encrypted, "wrong-secret") is None
+
+
+def test_store_and_get_key(kms):
+    account = create_accounts(kms, 1)[0]
+    assert kms.decrypt_key(kms.get_key(account["address"]), kms.SECRET) == account["private_key"]
+    assert kms.list_addresses() == [account["address"]]
+    assert kms.get_key("0xdead") is None
+
+
+def test_round_trip_through_compaction(kms, monkeypatch):
+    monkeypatch.setattr(kms, "COMPACT_THRESHOLD", 4)
+    accounts = [create_accounts(kms, 1)[0] for _ in range(10)]
+
+    # Two compactions folded 8 keys into the snapshot; the last 2 are still in the log
+    with open(kms.KEYSTORE_PATH, "rb") as f:
+        assert len(orjson.loads(f.read())) == 8
+    with open(kms.KEYSTORE_LOG_PATH, "rb") as f:
+        assert len(f.read().splitlines()) == 2
+
+    # A fresh process view (cold state) sees every key
+    monkeypatch.setattr(kms, "_disk_state", None)
+    assert set(kms.list_addresses()) == {a["address"] for a in accounts}
+    for account in accounts:
+        assert kms.decrypt_key(kms.get_key(account["address"]), kms.SECRET) == account["private_key"]
+
+
+def _store_in_other_process(tmp_path, n, compact_threshold=1000):
+    script = (
+        "import enclave_kms as k\n"
+        f"k.COMPACT_THRESHOLD = {compact_threshold}\n"
+        f"for a in k.generate_ethereum_accounts({n}):\n"
+        "    k.store_key(a['address'], k.encrypt_key(a['private_key'], k.SECRET))\n"
+        "print(','.join(k.list_addresses()))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=tmp_path,
+        env={"ENCLAVE_SECRET": TEST_SECRET, "PYTHONPATH": KMS_DIR},
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    return set(result.stdout.strip().split(","))
+
+
+def test_processes_see_each_others_keys(kms, tmp_path):
+    ours = {a["address"] for a in create_accounts(kms, 3)}
+
+    seen_by_other = _store_in_other_process(tmp_path, 2)
+    assert ours < seen_by_other
+
+    theirs = seen_by_other - ours
+    assert set(kms.list_addresses()) == seen_by_other
+    for address in theirs:
+        assert kms.sign_message("hello", address) is not None
+
+    # Our own writes still land on top of theirs
+    ours |= {a["address"] for a in create_accounts(kms, 1)}
+    assert set(kms.list_addresses()) == ours | theirs
+
+
+def test_compaction_racing_a_reader_is_not_missed(kms, tmp_path, monkeypatch):
+    create_accounts(kms, 1)
+    assert len(kms.list_addresses()) == 1
+
+    # Another worker appends, so the next read has to refresh...
+    _store_in_other_process(tmp_path, 1)
+
+    # ...and right before that refresh takes its lock, the other worker compacts and appends again
+    flock = kms.fcntl.flock
+    raced = []
+
+    def racing_flock(f, op):
+        if op == kms.fcntl.LOCK_SH and not raced:
+            raced.append(_store_in_other_process(tmp_path, 2, compact_threshold=2))
+        return flock(f, op)
+
+    monkeypatch.setattr(kms.fcntl, "flock", racing_flock)
+    assert set(kms.list_addresses()) == raced[0]
+    assert len(raced[0]) == 4
+
+
+def test_legacy_scrypt_keystore_still_decrypts(kms):
+    account = Account.create()
+    private_key = "0x" + bytes(account.key).hex()
+    legacy = Account.encrypt(private_key, TEST_SECRET, kdf="scrypt", iterations=2 ** 4)
+    with open(kms.KEYSTORE_PATH, "wb") as f:
+        f.write(orjson.dumps({account.address: legacy}, option=orjson.OPT_INDENT_2))
+
+    assert kms.decrypt_key(kms.get_key(account.address), kms.SECRET) == private_key
+    signature = kms.sign_message("hello", account.address)
+    assert kms.verify_message("hello", signature, account.address)
+
+
+def test_signatures_match_eth_account(kms):
+    account = create_accounts(kms, 1)[0]
+    signer = Account.from_key(account["private_key"])
+    for message in ["hello", "", "héllo ünïcode", "x" * 300]:
+        expected = signer.sign_message(encode_defunct(text=message)).signature.hex()
+        signature = kms.sign_message(message, account["address"])
+        assert signature == expected.removeprefix("0x")
+        assert kms.verify_message(message, "0x" + signature, account["address"])
+        assert not kms.verify_message(message + "!", signature, account["address"])
+
+
+SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+
+
+def _to_high_s(signature):
+    """The equivalent high-s form of a low-s signature (s -> n - s, flipped recovery id)"""
+    sig = bytes.fromhex(signature)
+    s = SECP256K1_ORDER - int.from_bytes(sig[32:64], "big")
+    return (sig[:32] + s.to_bytes(32, "big") + bytes([55 - sig[64]])).hex()
+
+
+def test_verify_matches_eth_account_on_v_and_high_s(kms):
+    account = create_accounts(kms, 1)[0]
+    address = account["address"]
+    signature = kms.sign_message("hello", address)
+    corrupted_v = signature[:-2] + "99"
+    high_s = _to_high_s(signature)
+
+    # eth_account recovers the high-s form too
+    assert Account.recover_message(encode_defunct(text="hello"), signature=bytes.fromhex(high_s)) == address
+
+    results = [kms.verify_message("hello", sig, address) for sig in (signature, corrupted_v, high_s)]
+    assert results == [True, False, True]
+
+
+def test_verify_rejects_malformed_signatures(kms):
+    address = create_accounts(kms, 1)[0]["address"]
+    for signature in ["zz", "0x123", "0x1234", "0x" + "00" * 65, ""]:
+        assert kms.verify_message("hello", signature, address) is False
+
+
+def test_key_cache_survives_new_keys_and_drops_replaced_ones(kms):
+    account = create_accounts(kms, 1)[0]
+    kms.sign_message("hello", account["address"])
+    assert kms._load_private_key.cache_info().currsize == 1
+
+    create_accounts(kms, 2)
+    assert kms._load_private_key.cache_info().currsize == 1
+
+    replacement = kms.generate_ethereum_account()
+    kms.store_key(account["address"], kms.encrypt_key(replacement["private_key"], kms.SECRET))
+    assert kms._load_private_key.cache_info().currsize == 0